@@ -2,7 +2,9 @@
 from entitydb.system import SystemCommands
 from entitydb.entity import Entity
 from entitydb.entitydb import EntityDB
+from entitydb.batch import batch_system
+from entitydb.parallel import parallel_system
 
 # Components are actually python dataclasses
 # This line is here for faster importing in other files
-from dataclasses import dataclass as component
+from entitydb.component import component
@@ -0,0 +1,33 @@
+import weakref
+
+
+class Archetype():
+    '''
+    All the entities that have exactly the same set of components
+    '''
+
+    __slots__ = ("names", "mask", "uids", "plans")
+
+    def __init__(self, names: frozenset[str], mask: int) -> None:
+        self.names: frozenset[str] = names
+        '''Names of the components every entity in this archetype has'''
+        self.mask: int = mask
+        '''The components as a bitset, with a bit for each component given out by the EntityDB'''
+        self.uids: set[int] = set()
+        '''UIDs of the entities in this archetype'''
+        self.plans: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        '''
+        Anything the EntityDB works out for running a system on this archetype, by system wrapper.
+        Only depends on the archetype's components, so entities coming and going don't change them.
+        Weak, so a plan is dropped along with its system.
+        '''
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def __repr__(self) -> str:
+        return f"Archetype({', '.join(sorted(self.names))}: {len(self.uids)} entities)"
+
+    def matches(self, required_mask: int, excluded_mask: int) -> bool:
+        '''Returns True if the entities in this archetype are matched by a query, given as component bitsets'''
+        return self.mask & required_mask == required_mask and not self.mask & excluded_mask
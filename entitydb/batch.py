@@ -0,0 +1,111 @@
+from collections import namedtuple
+from types import SimpleNamespace
+from typing import Callable, NamedTuple, Sequence
+
+
+# Set on functions marked with @batch_system, holds their BatchInfo
+BATCH_ATTRIBUTE = "__entitydb_batch__"
+
+# Array dtype kinds that are numbers (bool, int, unsigned int, float, complex).
+# Any other field is an object array, a fixed width string array would cut off longer strings written to it
+NUMERIC_KINDS = "biufc"
+
+# Classes made by get_columns_type, keyed by component type and whether they are for Numba
+_columns_types: dict[tuple[type, bool], type] = dict()
+
+
+class BatchInfo(NamedTuple):
+    kernel: Callable
+    '''What to call to run the system'''
+    compiled: bool
+    '''If the kernel was compiled with Numba'''
+
+
+def batch_system(func: Callable = None, *, numba: bool = False) -> Callable:
+    '''
+    Marks a function as a batch system. Instead of being called once per entity,
+    a batch system is called once per run with every matched entity.
+
+    Each parameter gets an object with a NumPy array for every field of the component,
+    with one element per matched entity. So a batch system for `Position` and
+    `Velocity` components looks like:
+    ```
+    @batch_system
+    def move(pos: Position, vel: Velocity):
+        pos.x += vel.x
+        return SystemCommands.SAVE_ENTITY
+    ```
+    Returned commands apply to every matched entity.
+
+    Compiled with Numba, the columns are a named tuple so the arrays
+    have to be changed in place:
+    ```
+    @batch_system(numba=True)
+    def move(pos: Position, vel: Velocity):
+        for i in range(len(pos.x)):
+            pos.x[i] += vel.x[i]
+        return SystemCommands.SAVE_ENTITY.value
+    ```
+
+    ## Rules
+    - Batch systems can only take required components, no `opt_*`, `Entity`, `EntityDB` or index params.
+    - `exclude=[...]` works like it does for other systems.
+    - Fields that aren't numbers (like strings) get arrays of Python objects.
+    - With `numba=True` the function is compiled with `numba.njit(cache=True)`,
+    so it must be written in the subset of Python that Numba supports.
+
+    Needs NumPy to be installed, and Numba if `numba=True`.
+    '''
+    def decorate(func: Callable) -> Callable:
+        # NumPy is only imported once a batch system is made, it is slow to import and most systems don't need it
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("Batch systems need numpy to be installed") from None
+
+        kernel = func
+        if numba:
+            try:
+                import numba as numba_module
+            except ImportError:
+                raise ImportError(
+                    "numba=True needs numba to be installed") from None
+            kernel = numba_module.njit(cache=True)(func)
+
+        # The original function is returned so its signature can still be parsed
+        setattr(func, BATCH_ATTRIBUTE, BatchInfo(kernel, numba))
+        return func
+
+    if func is None:
+        return decorate
+    return decorate(func)
+
+
+def get_columns_type(component_type: type, fields: Sequence[str], compiled: bool) -> type:
+    '''
+    Returns the class that holds the columns of a component type, like `PositionColumns(x, y)`.
+    Numba can only take named tuples, otherwise it is a namespace so columns can be reassigned.
+    '''
+    result = _columns_types.get((component_type, compiled))
+    if result is None:
+        name = f"{component_type.__name__}Columns"
+        result = namedtuple(name, fields) if compiled else type(
+            name, (SimpleNamespace,), {})
+        _columns_types[(component_type, compiled)] = result
+    return result
+
+
+def make_columns(component_type: type, fields: Sequence[str], values: Sequence[Sequence], compiled: bool) -> object:
+    '''
+    Creates the columns passed in to a batch system for a component type.
+    `values` has a sequence of every entity's value for each field.
+    '''
+    import numpy
+
+    columns = {}
+    for field, field_values in zip(fields, values):
+        column = numpy.asarray(field_values)
+        if column.dtype.kind not in NUMERIC_KINDS:
+            column = numpy.array(field_values, dtype=object)
+        columns[field] = column
+    return get_columns_type(component_type, fields, compiled)(**columns)
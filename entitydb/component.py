@@ -0,0 +1,34 @@
+import dataclasses
+
+
+# Set on classes made with @component, so systems can tell them apart from other annotations cheaply
+COMPONENT_ATTRIBUTE = "__entitydb_component__"
+
+
+def component(cls: type = None, /, **kwargs) -> type:
+    '''
+    Makes a class into a component. Components are actually python dataclasses,
+    so this takes the same arguments as `@dataclass`, like `@component(slots=True)`.
+    '''
+    def decorate(cls: type) -> type:
+        if kwargs.get("slots") and "_uid" not in cls.__dict__:
+            # The EntityDB stores its ID for the component in `_uid`, so slotted components need a slot for it
+            annotations = cls.__dict__.get("__annotations__", {})
+            annotations["_uid"] = object
+            cls.__annotations__ = annotations
+            cls._uid = dataclasses.field(default=None, init=False, repr=False, compare=False)
+        result = dataclasses.dataclass(cls, **kwargs)
+        setattr(result, COMPONENT_ATTRIBUTE, True)
+        return result
+
+    if cls is None:
+        return decorate
+    return decorate(cls)
+
+
+def is_component(t: object) -> bool:
+    '''
+    Returns True if a type is a component. Plain dataclasses count too,
+    they just take the slower check.
+    '''
+    return getattr(t, COMPONENT_ATTRIBUTE, False) is True or dataclasses.is_dataclass(t)
@@ -1,18 +1,24 @@
+import logging
+
 import entitydb
 
 
+_log = logging.getLogger(__name__)
+
+
 class Entity():
     '''
     A collection of components
     '''
 
+    # There can be a lot of entities loaded at once, slots keep them small
+    __slots__ = ("uid", "db", "_components", "_unloaded_components")
+
     def __init__(self, components: list[object]) -> None:
         self.uid: int
         self.db: entitydb.EntityDB
 
-        self._components: dict[type, object] = {}
-        for c in components:
-            self._components[type(c)] = c
+        self._components: dict[type, object] = {type(c): c for c in components}
 
         self._unloaded_components: list[str] = []
 
@@ -24,30 +30,23 @@ class Entity():
         Gets a list of component objects.
         May not return every component this entity possibly has, only gets ones that are loaded!
         '''
-        for component in self._unloaded_components:
-            print(
-                "Warning: get_components called while there is an unloaded component:", component)
+        if self._unloaded_components and _log.isEnabledFor(logging.WARNING):
+            _log.warning("get_components called while there are unloaded components: %s",
+                         ", ".join(self._unloaded_components))
         return list(self._components.values())
 
     def has_components(self, component_types: list[type]) -> bool:
         '''
         Returns true if this entity has all of the given components
         '''
-        for t in component_types:
-            if t not in self._components:
-                # Attempt to load it if it's in the unloaded components
-
-                return False
-        return True
+        # TODO Attempt to load it if it's in the unloaded components
+        return self._components.keys() >= set(component_types)
 
     def has_any_matching_components(self, component_types: list[type]) -> bool:
         '''
         Returns true if at least one of the components in the given list is present on this entity
         '''
-        for t in component_types:
-            if t in self._components:
-                return True
-        return False
+        return not self._components.keys().isdisjoint(component_types)
 
     def get(self, component_type: type) -> object:
         '''
@@ -1,11 +1,16 @@
 
+import dataclasses
 import inspect
+import operator
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
-from typing import Callable, Type
+from typing import Callable, Iterable, Type
 
 from entitydb.entity import Entity
-from entitydb.system import SystemCommands, SystemWrapper
+from entitydb.system import SystemCommands, SystemWrapper, WRAPPERS_ATTRIBUTE
 from entitydb.serializers import deserialize
 
 
@@ -14,6 +19,17 @@ PRIMARY_KEY = "_uid"
 ENTITY_TABLE = "_entities"
 ENTITY_REFERENCE = "_entity"
 
+# Bits of the command mask returned by SystemWrapper.run
+SAVE_ENTITY = SystemCommands.SAVE_ENTITY.value
+DELETE_ENTITY = SystemCommands.DELETE_ENTITY.value
+BREAK = SystemCommands.BREAK.value
+
+# Field names of each component class, and an attrgetter that reads all of them at once
+_field_getter_cache: dict[type, tuple[tuple[str, ...], Callable]] = dict()
+
+# Constructor arguments of each component class, see EntityDB.get_instance_variables
+_instance_variables_cache: dict[type, dict[str, Type]] = dict()
+
 
 class EntityDB():
     '''
@@ -27,12 +43,29 @@ class EntityDB():
         self.component_classes: dict[str, type] = dict()
         '''Component classes we have registered'''
 
+        self._parallel_executors: dict[tuple[int, int], ThreadPoolExecutor] = dict()
+        '''
+        Threads for running `@parallel_system`s, by nesting depth and number of workers. They are kept for the
+        lifetime of the EntityDB, so anything a worker thread opens (like a connection) gets reused.
+        A system that runs another parallel system gets the next depth's threads, as waiting on
+        chunks queued behind itself in the same pool would never finish.
+        '''
+        self._parallel_local = threading.local()
+        '''`depth` is how many parallel runs the current thread is inside of'''
+
     def add_entity(self, entity: Entity) -> int:
         '''
         Adds an entity, returns its ID
         '''
         raise NotImplementedError()
 
+    def add_entities(self, entities: list[Entity]) -> list[int]:
+        '''
+        Adds many entities, returns their IDs in the same order.
+        Can be a lot faster than adding them one at a time.
+        '''
+        return [self.add_entity(entity) for entity in entities]
+
     def new_entity(self, components: list[object]) -> int:
         '''
         Creates a new entity from a list of components.
@@ -61,6 +94,8 @@ class EntityDB():
         - Get the entity by adding `entity:Entity` to the params.
         - The EntityDB can be passed in by a param annotated with `EntityDB`. Can be used to create new entities or run more systems.
         - The loop index can be passed in by adding an `int` paramater
+        - Systems marked with `@batch_system` are run once on all matched entities together, see `entitydb.batch`
+        - Systems marked with `@parallel_system` are run on many entities at once by threads, see `entitydb.parallel`
         '''
         raise NotImplementedError()
 
@@ -85,15 +120,25 @@ class EntityDB():
         '''
         raise NotImplementedError()
 
+    def close(self) -> None:
+        '''
+        Releases any resources held by the storage backend, like open connections.
+        The EntityDB should not be used after this is called.
+        '''
+        for executor in self._parallel_executors.values():
+            executor.shutdown()
+        self._parallel_executors.clear()
+
     def _register_component_type(self, component: type) -> bool:
         '''
         Checks if this component has been seen before, if not, it
         registers it and calls the _setup_component_type function.
 
-        Returns False if the component has already been registered
+        Returns False if the component has already been registered.
+        A different class with the same name (like one that was redefined) replaces the old one.
         '''
         component_name = component.__name__
-        if component_name not in self.component_classes:
+        if self.component_classes.get(component_name) is not component:
             self.component_classes[component_name] = component
             self._setup_component_type(component)
             return True
@@ -109,38 +154,126 @@ class EntityDB():
         '''
         pass
 
-    def _run_on_entities(self, system: SystemWrapper, entity_components: dict[str, any]) -> None:
+    def _run_on_entities(self, system: SystemWrapper, entities: Iterable[Entity]) -> None:
         '''
-        entity_components is a dict:
-        {
-            eid: {
-                ComponentA: cid,
-                ComponentB: cid
-            },
-        }
+        Runs the system on each of the given entities, and carries out the
+        commands it returns.
 
+        Saves and deletes are collected while the system runs and done together
+        at the end, even if the system raises an exception part way through.
         '''
-        index = 0
-        for eid in entity_components:
-            # TODO optimization: read below
-            # Don't bother trying to load every component from DB this entity has,
-            # just load the ones that this function calls for
-            entity: Entity = self._load_entity_from_cids(
-                eid, entity_components[eid])
-            commands = system.run(entity, index)
-
-            # * Run the commands
-
-            if SystemCommands.DELETE_ENTITY in commands:
-                self.delete_entity(entity)
-
-            elif SystemCommands.SAVE_ENTITY in commands:
-                self.update_entity(entity)
-
-            if SystemCommands.BREAK in commands:
-                break
+        if system.batch is not None:
+            raise NotImplementedError(
+                f"{type(self).__name__} does not support batch systems")
+
+        if system.parallel is not None:
+            self._run_on_entities_in_parallel(system, list(entities))
+            return
+
+        to_save: list[Entity] = []
+        to_delete: list[Entity] = []
+        try:
+            index = 0
+            for entity in entities:
+                commands = system.run(entity, index)
+
+                # * Run the commands
+                # Most systems return nothing, so that is a single test
+
+                if commands:
+                    if commands & DELETE_ENTITY:
+                        to_delete.append(entity)
+
+                    elif commands & SAVE_ENTITY:
+                        to_save.append(entity)
+
+                    if commands & BREAK:
+                        break
+
+                index += 1
+        finally:
+            if to_save:
+                self._update_entities(to_save)
+            if to_delete:
+                self._delete_entities(to_delete)
+
+    def _run_on_entities_in_parallel(self, system: SystemWrapper, entities: list[Entity]) -> None:
+        '''
+        Runs a `@parallel_system` on contiguous chunks of the entities at the same time,
+        one thread per chunk. The commands are carried out once every chunk is done.
+        '''
+        if not entities:
+            return
+
+        # Rounded up, so there are never more chunks than workers
+        chunk_size = -(-len(entities) // system.parallel.workers)
+        starts = range(0, len(entities), chunk_size)
+        # The commands returned for each entity of each chunk, in order
+        chunk_commands: list[list[int]] = [[] for _ in starts]
+        # Set when any chunk breaks or raises an exception, to stop the others
+        stop = threading.Event()
+
+        depth = getattr(self._parallel_local, "depth", 0)
+
+        def run_chunk(chunk: int) -> None:
+            self._parallel_local.depth = depth + 1
+            start = starts[chunk]
+            commands = chunk_commands[chunk]
+            try:
+                for index in range(start, min(start + chunk_size, len(entities))):
+                    if stop.is_set():
+                        return
+                    result = system.run(entities[index], index)
+                    commands.append(result)
+                    if result and result & BREAK:
+                        stop.set()
+                        return
+            except BaseException:
+                stop.set()
+                raise
+
+        key = (depth, system.parallel.workers)
+        executor = self._parallel_executors.get(key)
+        if executor is None:
+            executor = self._parallel_executors[key] = ThreadPoolExecutor(max_workers=key[1])
+        futures = [executor.submit(run_chunk, chunk) for chunk in range(len(starts))]
+        wait(futures)
+
+        to_save: list[Entity] = []
+        to_delete: list[Entity] = []
+        for start, commands in zip(starts, chunk_commands):
+            for index, result in enumerate(commands, start):
+                if not result:
+                    continue
+                if result & DELETE_ENTITY:
+                    to_delete.append(entities[index])
+                elif result & SAVE_ENTITY:
+                    to_save.append(entities[index])
+
+        if to_save:
+            self._update_entities(to_save)
+        if to_delete:
+            self._delete_entities(to_delete)
+
+        # Raise the first exception from any of the chunks
+        for future in futures:
+            future.result()
+
+    def _update_entities(self, entities: list[Entity]) -> None:
+        '''
+        Saves many entities at once. Override this if the storage can
+        write them faster together than one at a time.
+        '''
+        for entity in entities:
+            self.update_entity(entity)
 
-            index += 1
+    def _delete_entities(self, entities: list[Entity]) -> None:
+        '''
+        Deletes many entities at once. Override this if the storage can
+        delete them faster together than one at a time.
+        '''
+        for entity in entities:
+            self.delete_entity(entity)
 
     def _create_component_from_data(self, component_type: type, component_data: dict[str, any], cid:any = None) -> object:
         component_vars = self.get_instance_variables(component_type)
@@ -162,33 +295,76 @@ class EntityDB():
         Analises the passed in system, putting it in a wrapper to easily access
         its properties.
         '''
-        result = SystemWrapper(self, system_func)
-        # Might be some components in the call signature we haven't seen yet
-        for component_type in result.get_components_from_signature():
-            self._register_component_type(component_type)
+        # Parsed systems are kept on the function, so its signature is only inspected on its first run
+        wrappers: weakref.WeakKeyDictionary = getattr(system_func, WRAPPERS_ATTRIBUTE, None)
+        result = wrappers.get(self) if wrappers is not None else None
+        if result is None:
+            result = SystemWrapper(self, system_func)
+            # Might be some components in the call signature we haven't seen yet
+            for component_type in result.get_components_from_signature():
+                self._register_component_type(component_type)
+            self._setup_system(result)
+
+            if wrappers is None:
+                wrappers = weakref.WeakKeyDictionary()
+                try:
+                    setattr(system_func, WRAPPERS_ATTRIBUTE, wrappers)
+                except AttributeError:
+                    # Things like bound methods can't have attributes set, they just get parsed every time
+                    pass
+            wrappers[self] = result
         return result
 
+    def _setup_system(self, system: SystemWrapper) -> None:
+        '''
+        Called the first time a system is parsed. Only called once for each
+        system function (bound methods are parsed every run), after the components in its signature are registered.
+
+        Use this as an opportunity to precompute anything needed to query for this system,
+        and store it on the wrapper. For example, the WHERE clause of an SQL query.
+        '''
+        pass
+
     @classmethod
     def get_variables_of(cls, o: object) -> dict[str, object]:
         '''
         Returns the public variables of this object.
         Result is a dict of the var name, to its value
-        '''
-        result = dict()
 
-        var_names = dir(o)
-        for var_name in var_names:
-            attr = getattr(o, var_name)
-            if not var_name.startswith("_"):
-                result[var_name] = attr
-
-        return result
+        Components are dataclasses, which take the fast path using their cached fields.
+        This also works for dataclasses with `slots=True`, which have no `__dict__`.
+        Other objects fall back to reading their `__dict__`.
+        '''
+        o_type = type(o)
+        cached = _field_getter_cache.get(o_type)
+        if cached is None:
+            if not dataclasses.is_dataclass(o_type):
+                if not hasattr(o, "__dict__"):
+                    raise TypeError(
+                        f"Can't get the variables of {o_type.__name__}, components must be dataclasses")
+                return {k: v for k, v in vars(o).items() if not k.startswith("_")}
+
+            names = tuple(field.name for field in dataclasses.fields(o_type)
+                          if not field.name.startswith("_"))
+            cached = (names, operator.attrgetter(*names) if names else None)
+            _field_getter_cache[o_type] = cached
+
+        names, getter = cached
+        if not names:
+            return {}
+        # attrgetter returns a bare value rather than a tuple when there is only one name
+        values = getter(o) if len(names) > 1 else (getter(o),)
+        return dict(zip(names, values))
 
     @classmethod
     def get_instance_variables(cls, t: Type) -> dict[str, Type]:
         '''
-        Given a type (class), will return the arguments needed to construct it
+        Given a type (class), will return the arguments needed to construct it.
+        The result is cached per type, so don't change it.
         '''
-        args = inspect.getfullargspec(t.__init__).annotations
-        args.pop("return", None)
+        args = _instance_variables_cache.get(t)
+        if args is None:
+            args = inspect.getfullargspec(t.__init__).annotations
+            args.pop("return", None)
+            _instance_variables_cache[t] = args
         return args
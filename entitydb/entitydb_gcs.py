@@ -1,7 +1,10 @@
+import base64
+import os
 import random
 import sys
 import string
-from typing import Callable, Type, final
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Sequence, Type, final
 from entitydb.entitydb import EntityDB, PRIMARY_KEY, ENTITY_REFERENCE, ENTITY_TABLE
 from entitydb.entity import Entity
 from entitydb.system import SystemWrapper, SystemCommands
@@ -10,6 +13,8 @@ from google.cloud import storage
 from google.cloud.storage import Bucket, Blob
 import google.api_core.exceptions as google_exceptions
 from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from entitydb.serializers import serialize
 
 
@@ -18,13 +23,34 @@ BLOBNAME_DELIMITER = "/"
 ENTITY_FOLDER = "ent"
 COMPONENT_FOLDER = "cmp"
 DATA_FOLDER = "dat"
+ARCHETYPE_FOLDER = "arc"
 UID_LENGTH = 16
+# Blob uploads and downloads are done in parallel by this many threads, all sharing one connection pool
+UPLOAD_WORKERS = 100
+# Most requests GCS allows in one batch
+BATCH_SIZE = 100
+# An empty blob that index blobs are copied from, as copies can be batched but uploads can't
+EMPTY_BLOB = "_empty"
+# Exists once every entity in the bucket has an archetype blob, buckets made before those were written get them added
+ARCHETYPES_BLOB = "_archetypes"
+# Only the names of listed blobs are used, so that's all that is asked for
+LIST_FIELDS = "items(name),prefixes,nextPageToken"
+# Most blobs GCS will list in one page
+LIST_PAGE_SIZE = 1000
 
 
 class EntityDB_GCS(EntityDB):
     def __init__(self, bucket_name: str) -> None:
         self.storage_client = storage.Client()
+        # The default pool only keeps 10 connections, which would serialize the upload threads.
+        # Connections that drop are retried here, instead of failing a whole batch of small requests
+        self.storage_client._http.mount("https://", HTTPAdapter(
+            pool_connections=UPLOAD_WORKERS, pool_maxsize=UPLOAD_WORKERS,
+            max_retries=Retry(total=3, backoff_factor=0.1)))
         self.bucket = self._init_bucket(bucket_name)
+        self._executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        self._empty_blob = self._init_empty_blob()
+        self._init_archetypes()
 
         # Add a new object
         # blob = self.bucket.blob("empty_file")
@@ -43,87 +69,78 @@ class EntityDB_GCS(EntityDB):
 
         component_uids = []
 
+        # Every blob for this entity, created all at once at the end
+        index_names: list[str] = []
+        uploads: list[tuple[str, object, str]] = []
+
         # * Add each component
-        for component in entity.get_components():
+        for component in entity._components.values():
             self._register_component_type(type(component))
             component_name = type(component).__name__
             component._uid = self._random_cid()
             component_uids.append(component._uid)
             # Map of entities to components
-            self._create_empty_blob(
+            index_names.append(
                 f"{ENTITY_FOLDER}/{entity.uid}/{component_name}-{component._uid}")
             # Map of components to entities
-            self._create_empty_blob(
+            index_names.append(
                 f"{COMPONENT_FOLDER}/{component_name}/{entity.uid}-{component._uid}")
 
             # Actual data
             vars = EntityDB.get_variables_of(component)
             for varname in vars:
-                self._create_data_blob(component._uid, varname, vars[varname])
+                data, mime_type = serialize(vars[varname])
+                uploads.append(
+                    (f"{DATA_FOLDER}/{component._uid}/{varname}", data, mime_type))
+
+        # Map of archetypes to entities
+        index_names.append(get_archetype_blob_name(entity.uid, {
+            type(component).__name__: component._uid for component in entity._components.values()}))
 
+        self._upload_blobs(uploads, index_names)
         return new_eid
 
     def update_entity(self, entity: Entity) -> bool:
-        for component in entity.get_components():
-            vars = EntityDB.get_variables_of(component)
-            for varname in vars:
-                self._create_data_blob(component._uid, varname, vars[varname])
+        self._update_entities([entity])
+        return True
 
     def delete_entity(self, entity: Entity) -> None:
         if not entity.uid:
             raise Exception("Entity has not been saved yet")
-        super().delete_entity(entity)
+        self._delete_entities([entity])
 
     def run(self, system_func: Callable) -> None:
         system = self._parse_system(system_func)
 
-        # * Find all components matching in the query
+        # * Find all archetypes matching the query
 
-        # A set of entity IDs that match the query
-        matched_eids: set = None
+        # Components that get loaded, if the entity has them
+        wanted_names = system.required_names | system.optional_names
 
         # All found eids, and their dict of component names to cids (only components that exist in the query)
         all_entities: dict[str, dict[str, str]] = dict()
 
-        for var_name in system.include_components:
-            component_name = system.include_components[var_name].__name__
-            blobs = self._search_blobs(f"{COMPONENT_FOLDER}/{component_name}/")
-            found_components: set[str] = set()
-            for blob in blobs:
-                eid, cid = blob.name.split(BLOBNAME_DELIMITER)[-1].split("-")
-                found_components.add(eid)
-                if eid in all_entities:
-                    all_entities[eid][component_name] = cid
-                else:
-                    all_entities[eid] = {component_name: cid}
-
-            if matched_eids:
-                matched_eids = matched_eids & found_components
-            else:
-                matched_eids = found_components
-
-        # TODO search the ENTITIES_FOLDER instead
-        for component in system.exclude_components:
-            blobs = self._search_blobs(f"{COMPONENT_FOLDER}/{component.__name__}/")
-            exclude_eids: set[str] = set()
-            for blob in blobs:
-                eid, cid = blob.name.split(BLOBNAME_DELIMITER)[-1].split("-")
-                exclude_eids.add(eid)
-            matched_eids -= exclude_eids
-
-        # TODO optional components
+        for archetype in self._list_archetypes():
+            if not system.required_names.issubset(archetype) or not system.excluded_names.isdisjoint(archetype):
+                continue
+            # One blob per entity in the archetype, with the cids in its name
+            for blob in self._search_blobs(f"{ARCHETYPE_FOLDER}/{'-'.join(archetype)}/", flat=True):
+                eid, *cids = blob.name.split(BLOBNAME_DELIMITER)[-1].split("-")
+                all_entities[eid] = {
+                    name: cid for name, cid in zip(archetype, cids) if name in wanted_names}
 
-        # * Load the components of the matched eids
-        matched_entities: dict[str, dict[str, str]] = dict()
-
-        for eid in matched_eids:
-            matched_entities[eid] = all_entities[eid]
-
-        self._run_on_entities(system, matched_entities)
+        # * Load the components of the matched eids, one entity at a time
+        self._run_on_entities(system, (self._load_entity_from_cids(
+            eid, all_entities[eid]) for eid in all_entities))
 
     def count_matches(self, system_func: Callable) -> int:
         return super().count_matches(system_func)
 
+    def close(self) -> None:
+        super().close()
+        self._executor.shutdown()
+        self.storage_client.close()
+
     def _init_bucket(self, bucket_name: str):
         '''Ensures the bucket exists, creates it if it doesn't'''
         try:
@@ -139,27 +156,138 @@ class EntityDB_GCS(EntityDB):
         print(f"Bucket {new_bucket.name} created.")
         return new_bucket
 
+    def _init_empty_blob(self) -> Blob:
+        '''Ensures the blob that empty blobs are copied from exists'''
+        blob = self.bucket.blob(EMPTY_BLOB)
+        if not blob.exists():
+            blob.upload_from_string("")
+        return blob
+
+    def _init_archetypes(self) -> None:
+        '''
+        Ensures every entity has an archetype blob, as queries only look in the archetype folder.
+        Entities added before archetype blobs existed only have their `ent/` and `cmp/` index,
+        so their archetype blobs are made from the `ent/` index, once per bucket.
+        '''
+        marker = self.bucket.blob(ARCHETYPES_BLOB)
+        if marker.exists():
+            return
+
+        entities: dict[str, dict[str, str]] = dict()
+        for blob in self._search_blobs(f"{ENTITY_FOLDER}/", flat=True):
+            _, eid, component = blob.name.split(BLOBNAME_DELIMITER)
+            component_name, cid = component.split("-")
+            entities.setdefault(eid, {})[component_name] = cid
+
+        existing = {blob.name for blob in self._search_blobs(f"{ARCHETYPE_FOLDER}/", flat=True)}
+        names = [get_archetype_blob_name(eid, components) for eid, components in entities.items()]
+        self._create_empty_blobs([name for name in names if name not in existing])
+        marker.upload_from_string("")
+
     def _list_buckets(self) -> list[Bucket]:
         buckets = self.storage_client.list_buckets()
         result = []
         for bucket in buckets:
             result.append(bucket)
         return result
-    
-    def _create_data_blob(self, cid: str, varname: str, data: object) -> Blob:
-        '''Creates a blob that stores a field in a component'''
-        new_blob = self.bucket.blob(f"{DATA_FOLDER}/{cid}/{varname}")
-        final_data, mime_type = serialize(data)     
-        new_blob.content_type = mime_type
-        new_blob.upload_from_string(final_data, content_type=mime_type)
-        return new_blob
-
-    def _create_empty_blob(self, name: str) -> Blob:
-        return self.bucket.blob(name).upload_from_string("")
+
+    def _create_empty_blobs(self, names: Sequence[str]) -> None:
+        '''
+        Creates many empty blobs, sending up to `BATCH_SIZE` of them per request.
+        '''
+        for start in range(0, len(names), BATCH_SIZE):
+            with self.storage_client.batch():
+                for name in names[start:start + BATCH_SIZE]:
+                    self.bucket.copy_blob(self._empty_blob, self.bucket, name)
+
+    def _update_entities(self, entities: list[Entity]) -> None:
+        '''Uploads the fields of every loaded component of the entities, all at once'''
+        uploads: list[tuple[str, object, str]] = []
+        for entity in entities:
+            for component in entity._components.values():
+                vars = EntityDB.get_variables_of(component)
+                for varname in vars:
+                    data, mime_type = serialize(vars[varname])
+                    uploads.append(
+                        (f"{DATA_FOLDER}/{component._uid}/{varname}", data, mime_type))
+        self._upload_blobs(uploads)
+
+    def _delete_entities(self, entities: list[Entity]) -> None:
+        '''Deletes every blob of the given entities, in batches'''
+        def list_names(prefix: str) -> list[str]:
+            return [blob.name for blob in self._search_blobs(prefix, flat=True)]
+
+        # The entity's index has every component it has, not just the loaded ones
+        entity_blobs = self._executor.map(
+            list_names, [f"{ENTITY_FOLDER}/{entity.uid}/" for entity in entities])
+
+        names: list[str] = []
+        data_folders: list[str] = []
+        # Archetype blobs that might not exist, which would fail a whole batch
+        maybe_missing: list[str] = []
+        for entity, blob_names in zip(entities, entity_blobs):
+            components: dict[str, str] = {}
+            for blob_name in blob_names:
+                component_name, cid = blob_name.split(BLOBNAME_DELIMITER)[-1].split("-")
+                components[component_name] = cid
+                names.append(blob_name)
+                names.append(f"{COMPONENT_FOLDER}/{component_name}/{entity.uid}-{cid}")
+                data_folders.append(f"{DATA_FOLDER}/{cid}/")
+            # With no index there's no way to tell an entity without components from one already deleted
+            if components:
+                names.append(get_archetype_blob_name(entity.uid, components))
+            else:
+                maybe_missing.append(get_archetype_blob_name(entity.uid, components))
+
+        for data_names in self._executor.map(list_names, data_folders):
+            names += data_names
+
+        self._delete_blobs(names)
+        for name in maybe_missing:
+            try:
+                self.bucket.delete_blob(name)
+            except google_exceptions.NotFound:
+                pass
+
+    def _list_archetypes(self) -> list[tuple[str, ...]]:
+        '''Returns every archetype that has entities, as a sorted tuple of component names'''
+        blobs = self._search_blobs(f"{ARCHETYPE_FOLDER}/")
+        # Prefixes are only filled in as the pages are read
+        for _ in blobs.pages:
+            pass
+        return [tuple(prefix.split(BLOBNAME_DELIMITER)[1].split("-")) for prefix in blobs.prefixes]
+
+    def _delete_blobs(self, names: list[str]) -> None:
+        '''
+        Deletes many blobs, sending up to `BATCH_SIZE` of them per request.
+        '''
+        for start in range(0, len(names), BATCH_SIZE):
+            with self.storage_client.batch():
+                for name in names[start:start + BATCH_SIZE]:
+                    self.bucket.delete_blob(name)
+
+    def _upload_blobs(self, uploads: list[tuple[str, object, str]], empty_names: Sequence[str] = ()) -> None:
+        '''
+        Uploads many blobs in parallel, and waits for them all to finish.
+        Each upload is a tuple of the blob name, its data and its mime type.
+        Blobs in `empty_names` are created in batches while the uploads run.
+        Raises the first exception from any of the uploads.
+        '''
+        def upload(name: str, data: object, mime_type: str) -> None:
+            self.bucket.blob(name).upload_from_string(data, content_type=mime_type)
+
+        results = self._executor.map(upload, *zip(*uploads))
+        # Batches are per thread, so this doesn't get mixed up with the uploads
+        self._create_empty_blobs(empty_names)
+
+        # Consuming the results waits for every upload, and raises their exceptions
+        for _ in results:
+            pass
 
     def _random_id(self, length: int) -> str:
-        '''Create a new random ID'''
-        return "".join(random.choice(string.ascii_letters + string.digits) for i in range(length))
+        '''Create a new random ID, of upper case letters and digits'''
+        # Base32 has 5 bits per char, and never uses the "-" that separates IDs in blob names
+        return base64.b32encode(os.urandom(length * 5 // 8 + 1)).decode()[:length]
 
     def _random_eid(self) -> str:
         '''Create a new random ID for use in entities. First char will always be a number'''
@@ -169,27 +297,53 @@ class EntityDB_GCS(EntityDB):
         '''Create a new random ID for use in components. First char will always be a letter'''
         return random.choice(string.ascii_letters) + self._random_id(UID_LENGTH - 1)
 
-    def _search_blobs(self, prefix: str):
+    def _search_blobs(self, prefix: str, flat: bool = False):
         '''
         Finds blobs that start with a specified prefix.
+        With `flat=True` the listing isn't split up into folders, which takes fewer requests.
+        Only use it when there are no subfolders to skip, or you want everything in them anyway.
 
         Note: if searching in a folder, ensure there is a trailing `BLOBNAME_DELIMITER` (`/`)
         '''
-        return self.storage_client.list_blobs(self.bucket, prefix=prefix, delimiter=BLOBNAME_DELIMITER)
+        return self.storage_client.list_blobs(
+            self.bucket, prefix=prefix, delimiter=None if flat else BLOBNAME_DELIMITER,
+            fields=LIST_FIELDS, page_size=LIST_PAGE_SIZE)
 
     def _load_entity_from_cids(self, eid: str, components: dict[str, str]) -> Entity:
         result = Entity([])
         result.uid = eid
-        for comp_name in components:
-            cid = components[comp_name]
+
+        # * Find and download the fields of every component at once
+
+        def list_fields(cid: str) -> list[Blob]:
+            return list(self._search_blobs(f"{DATA_FOLDER}/{cid}/", flat=True))
+
+        def download(blob: Blob) -> tuple[str, bytes]:
+            return blob.name, blob.download_as_bytes()
+
+        # The field blobs of each component, in the same order as `components`
+        component_blobs = list(self._executor.map(list_fields, components.values()))
+        downloaded = dict(self._executor.map(
+            download, [blob for blobs in component_blobs for blob in blobs]))
+
+        for comp_name, cid, blobs in zip(components, components.values(), component_blobs):
             component_data: dict = dict()
-            blobs: list[Blob] = self._search_blobs(f"{DATA_FOLDER}/{cid}/")
             # Iterate over every property in the blob
             for blob in blobs:
                 varname = blob.name.split("/")[-1]
-                component_data[varname] = blob.download_as_bytes()
+                component_data[varname] = downloaded[blob.name]
             # Need to get the component name somehow, might need to rethink how the data is stored
             component_type = self.component_classes[comp_name]
             new_component = self._create_component_from_data(component_type, component_data, cid)
             result._components[component_type] = new_component
         return result
+
+
+def get_archetype_blob_name(eid: str, components: dict[str, str]) -> str:
+    '''
+    Returns the name of the blob that puts an entity in its archetype, given its component names to cids.
+    Looks like `arc/Position-Velocity/<eid>-<Position cid>-<Velocity cid>`,
+    so listing an archetype's folder finds every cid of its entities too.
+    '''
+    names = sorted(components)
+    return f"{ARCHETYPE_FOLDER}/{'-'.join(names)}/" + "-".join([eid] + [components[name] for name in names])
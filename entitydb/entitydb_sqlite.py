@@ -1,130 +1,265 @@
+import functools
 import inspect
 import os
 import random
-import sys
 import sqlite3
-from typing import Callable, Type
-from entitydb.entitydb import EntityDB, PRIMARY_KEY, ENTITY_REFERENCE, ENTITY_TABLE
+import threading
+from typing import Callable, NamedTuple, Type
+from entitydb.entitydb import EntityDB, PRIMARY_KEY, ENTITY_REFERENCE, ENTITY_TABLE, SAVE_ENTITY, DELETE_ENTITY
+from entitydb.archetype import Archetype
+from entitydb.batch import make_columns
 from entitydb.entity import Entity
 from entitydb.system import SystemWrapper, SystemCommands
 
 
+# UIDs are random positive ints that fit in an SQLite INTEGER (signed 64 bit)
+UID_BITS = 63
+_random_uid = random.getrandbits
+
+# Components are stored inline in the entities table. Each component has a column
+# named after it holding its UID (NULL if the entity doesn't have it), and one
+# column per field, named like "Position__x"
+FIELD_DELIMITER = "__"
+
+# Most values that can be bound in one statement, SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+MAX_QUERY_PARAMETERS = 999
+
+
+class ComponentStatements(NamedTuple):
+    '''
+    The SQL used to store a component type, built once when it is registered
+    '''
+    fields: tuple[str, ...]
+    columns: tuple[str, ...]
+    '''The component's UID column, followed by a column for each field'''
+    insert_columns: str
+    '''`columns` joined with commas, for an INSERT'''
+    insert_placeholders: str
+    '''A question mark for each of the `columns`, like `"?,?,?"`'''
+    update_set: str
+    '''Like `"Position__x = ?, Position__y = ?"`, takes `*fields`'''
+    select: str
+    '''Selects the columns of this component from an entity, takes `_uid`'''
+
+
+class LoadPlan(NamedTuple):
+    '''How a system loads the entities of one archetype, see `EntityDB_SQLite._create_entity_from_row`'''
+    components: tuple[tuple[type, int, int, tuple[str, ...]], ...]
+    '''The system's `loaded_components` that the archetype has'''
+    unloaded: tuple[str, ...]
+    '''Names of the archetype's components that the system doesn't load'''
+
+
 class EntityDB_SQLite(EntityDB):
+    '''
+    Stores entities in a single SQLite table, see `FIELD_DELIMITER`
+    for how components are laid out in it.
+    '''
+
     def __init__(self, db_file_name: str) -> None:
         super().__init__()
         self.db_file_name = db_file_name
+        self._component_statements: dict[type, ComponentStatements] = dict()
+        self._table_columns: dict[str, set[str]] = dict()
+        '''Column names of each table we have looked at, so the schema is only read once'''
+
+        self._archetypes: dict[frozenset[str], Archetype] = None
+        '''
+        The entities with each set of component names, so queries can be answered
+        without scanning the entities table. Built on the first query, see `_get_archetypes`.
+        Built again if something else writes to the database file, see `_check_for_outside_writes`.
+        '''
+        self._entity_archetypes: dict[int, Archetype] = dict()
+        '''The archetype of each entity'''
+        self._component_index: dict[str, list[Archetype]] = dict()
+        '''Every archetype that has each component, so queries only look at archetypes that could match'''
+        self._component_bits: dict[str, int] = dict()
+        '''The bit of each component name in archetype and query bitsets, see `_get_mask`'''
+        self._query_cache: dict[tuple[int, int], list[Archetype]] = dict()
+        '''
+        Matching archetypes found by `_find_archetypes`, by required and excluded component bitsets.
+        Entities moving between archetypes don't change these, only new archetypes do, see `_set_archetype`.
+        '''
         # Create database if it does not exist
-        if not os.path.isfile(db_file_name):
+        is_new_db = not os.path.isfile(db_file_name)
+
+        # Each thread keeps one connection open for the lifetime of this EntityDB
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        '''Every connection opened by `_connect_to_db`, so they can all be closed'''
+
+        if is_new_db:
             self._create_db()
-    pass
+        else:
+            self._migrate_component_tables()
+
+    def close(self) -> None:
+        # Worker threads are stopped first, so none of them are still using a connection
+        super().close()
+        for con in self._connections:
+            con.close()
+        self._connections.clear()
 
     def add_entity(self, entity: Entity) -> int:
-        new_id = random.randint(0, sys.maxsize)
-        entity.uid = new_id
-        entity.db = self
+        return self.add_entities([entity])[0]
+
+    def add_entities(self, entities: list[Entity]) -> list[int]:
+        '''
+        Adds all the entities in one transaction. Entities with the same
+        component types are inserted together in one executemany.
+        '''
+        # The rows of each set of columns, by the component types that make up the columns
+        layout_rows: dict[tuple[type, ...], list[list]] = {}
+        new_ids = []
+        for entity in entities:
+            new_id = _random_uid(UID_BITS)
+            entity.uid = new_id
+            entity.db = self
+            new_ids.append(new_id)
+
+            # The entity and all of its components are a single row
+            values = [entity.uid]
+
+            # * Add each component
+            for component_type, component in entity._components.items():
+                self._register_component_type(component_type)
+                fields = self._component_statements[component_type].fields
+
+                # Create a unique ID for this component
+                component._uid = _random_uid(UID_BITS)
+                values.append(component._uid)
+                values += [getattr(component, field) for field in fields]
+
+            layout_rows.setdefault(tuple(entity._components), []).append(values)
 
         con, cur = self._connect_to_db()
+        with con:
+            for component_types, rows in layout_rows.items():
+                statements = [self._component_statements[component_type]
+                              for component_type in component_types]
+                columns = [PRIMARY_KEY] + [statement.insert_columns for statement in statements]
+                placeholders = ["?"] + [statement.insert_placeholders for statement in statements]
+                cur.executemany(
+                    f"INSERT INTO {ENTITY_TABLE} ({','.join(columns)}) VALUES ({','.join(placeholders)})", rows)
+
+        for entity in entities:
+            self._set_archetype(entity.uid, get_archetype_of(entity))
+        return new_ids
 
-        component_uids = []
+    def update_entity(self, entity: Entity) -> bool:
+        con, cur = self._connect_to_db()
 
-        # * Add each component
-        for component in entity.get_components():
-            component_name = type(component).__name__
-            self._register_component_type(type(component))
+        # Only loaded components can have changed, unloaded ones are left as they are
+        update_sets = []
+        values = []
+        components_added = False
+        for component_type, component in entity._components.items():
+            self._register_component_type(component_type)
+            statements = self._component_statements[component_type]
+
+            # Components added to the entity since it was stored don't have a UID yet
+            if getattr(component, "_uid", None) is None:
+                component._uid = _random_uid(UID_BITS)
+                update_sets.append(f"{statements.columns[0]} = ?")
+                values.append(component._uid)
+                components_added = True
+
+            if statements.fields:
+                update_sets.append(statements.update_set)
+                values += [getattr(component, field) for field in statements.fields]
+
+        if update_sets:
+            with con:
+                cur.execute(
+                    f"UPDATE {ENTITY_TABLE} SET {', '.join(update_sets)} WHERE {PRIMARY_KEY} = ?", values + [entity.uid])
 
-            # Create a unique ID for this component
-            component._uid = random.randint(0, sys.maxsize)
-            component_uids.append(component._uid)
-            columns = [PRIMARY_KEY, ENTITY_REFERENCE] + \
-                list(EntityDB.get_variables_of(component).keys())
-            cur.execute(f"INSERT INTO {component_name} ({','.join(columns)}) VALUES ({get_questionmarks(len(columns))})", [
-                        component._uid] + [entity.uid] + list(EntityDB.get_variables_of(component).values()))
-            con.commit()
+        if components_added:
+            self._set_archetype(entity.uid, get_archetype_of(entity))
+        return True
 
-        # * Add the entity
+    def delete_entity(self, entity: Entity) -> None:
+        self._delete_entities([entity])
 
-        # Get the columns we are inserting. This is the UID plus one for each component
-        columns = [PRIMARY_KEY] + \
-            [component_type.__name__ for component_type in entity.get_component_types()]
+    def _update_entities(self, entities: list[Entity]) -> None:
+        '''
+        Saves the loaded components of many entities in one transaction,
+        with one executemany per component type.
+        '''
+        # Rows of `*fields, _uid` for each component type
+        component_rows: dict[type, list[list]] = {}
+        for entity in entities:
+            components = entity._components
+            if any(getattr(component, "_uid", None) is None for component in components.values()):
+                # Components were added to this entity, update_entity handles storing them
+                self.update_entity(entity)
+                continue
+
+            for component_type, component in components.items():
+                fields = self._component_statements[component_type].fields
+                if fields:
+                    component_rows.setdefault(component_type, []).append(
+                        [getattr(component, field) for field in fields] + [entity.uid])
 
-        cur.execute(f"INSERT INTO {ENTITY_TABLE} ({','.join(columns)}) VALUES ({get_questionmarks(len(columns))})", [
-                    entity.uid] + component_uids)
-        con.commit()
-        con.close()
-        return new_id
+        con, cur = self._connect_to_db()
+        with con:
+            for component_type, rows in component_rows.items():
+                cur.executemany(
+                    f"UPDATE {ENTITY_TABLE} SET {self._component_statements[component_type].update_set} WHERE {PRIMARY_KEY} = ?", rows)
 
-    def update_entity(self, entity: Entity) -> bool:
+    def _delete_entities(self, entities: list[Entity]) -> None:
         con, cur = self._connect_to_db()
-        for component in entity.get_components():
-            component_name = type(component).__name__
-            component_variables = EntityDB.get_variables_of(component)
-            cvar_update_strings = []
-            for varname in component_variables:
-                cvar_update_strings.append(f"{varname} = ?")
-            statement = f"UPDATE {component_name} SET {', '.join(cvar_update_strings)} WHERE {ENTITY_REFERENCE} = {entity.uid}"
-            cur.execute(statement, list(component_variables.values()))
-        con.commit()
-        con.close()
-        return True
+        with con:
+            cur.executemany(
+                f"DELETE FROM {ENTITY_TABLE} WHERE {PRIMARY_KEY} = ?", [[entity.uid] for entity in entities])
+        for entity in entities:
+            self._set_archetype(entity.uid, None)
 
     def run(self, system_func: Callable) -> None:
         system = self._parse_system(system_func)
 
-        # A string like "Comp_A IS NOT NULL AND Comp_N IS NULL"
-        where_clause = " AND ".join(
-            # Include required components
-            [f"{system.include_components[comp].__name__} IS NOT NULL" for comp in system.include_components] +
-
-            # Excluded components
-            [f"{comp.__name__} IS NULL" for comp in system.exclude_components]
-        )
-
-        con, cur = self._connect_to_db()
-        # TODO Don't SELECT * (all), just select the components needed for this query
-        cur.execute(f"SELECT * FROM {ENTITY_TABLE} WHERE ({where_clause})")
-        found_entities: list[dict[str, str]] = cur.fetchall()
-        con.close()
-        entity_components: dict[int, dict[str, int]] = dict()
-        for entity in found_entities:
-            entity_components[entity.pop(PRIMARY_KEY)] = entity
-        self._run_on_entities(system, entity_components)
+        # Load the matched entities of each archetype, as many at a time as SQLite lets us pass in.
+        # The rows are kept with the archetype they were found in, as the system can move entities around
+        con, cur = self._connect_to_db(False)
+        found_entities: list[tuple[Archetype, list[tuple]]] = []
+        for archetype in self._find_archetypes(system):
+            matched_uids = list(archetype.uids)
+            rows: list[tuple] = []
+            for i in range(0, len(matched_uids), MAX_QUERY_PARAMETERS):
+                uids = matched_uids[i:i + MAX_QUERY_PARAMETERS]
+                if len(uids) == MAX_QUERY_PARAMETERS:
+                    cur.execute(system.select_full_sql, uids)
+                else:
+                    cur.execute(
+                        f"{system.select_sql} ({get_questionmarks(len(uids))})", uids)
+                rows += cur.fetchall()
+            if rows:
+                found_entities.append((archetype, rows))
+
+        if system.batch is not None:
+            self._run_batch(system, [row for _, rows in found_entities for row in rows])
+        else:
+            self._run_on_entities(system, (self._create_entity_from_row(
+                row, system, archetype) for archetype, rows in found_entities for row in rows))
 
     def count_matches(self, system_func: Callable) -> int:
-        # TODO some code can be shared with EntityDB.run()
-
         system = self._parse_system(system_func)
-
-        # A string like "Comp_A IS NOT NULL AND Comp_N IS NULL"
-        where_clause = " AND ".join(
-            # Include required components
-            [f"{system.include_components[comp].__name__} IS NOT NULL" for comp in system.include_components] +
-
-            # Excluded components
-            [f"{comp.__name__} IS NULL" for comp in system.exclude_components]
-        )
-
-        con, cur = self._connect_to_db(False)
-        cur.execute(
-            f"SELECT COUNT(*) FROM {ENTITY_TABLE} WHERE ({where_clause})")
-        result = cur.fetchone()[0]
-        con.close()
-        return result
+        return sum(len(archetype) for archetype in self._find_archetypes(system))
 
     def load_component(self, entity: Entity, component_type: type) -> bool:
         self._register_component_type(component_type)
         component_name = component_type.__name__
 
-        con, cur = self._connect_to_db()
-        cur.execute(
-            f"SELECT * FROM {component_name} WHERE {ENTITY_REFERENCE} = {entity.uid}")
-        component_data: dict = cur.fetchone()
-        con.close()
+        statements = self._component_statements[component_type]
+        con, cur = self._connect_to_db(False)
+        cur.execute(statements.select, [entity.uid])
+        row: tuple = cur.fetchone()
 
-        if not component_data:
+        # Either the entity doesn't exist or it doesn't have this component
+        if not row or row[0] is None:
             return False
 
         new_component = self._create_component_from_data(
-            component_type, component_data, component_data[PRIMARY_KEY])
+            component_type, dict(zip(statements.fields, row[1:])), row[0])
 
         entity._components[component_type] = new_component
         if component_name in entity._unloaded_components:  # Clean up
@@ -133,11 +268,29 @@ class EntityDB_SQLite(EntityDB):
         return True
 
     def _connect_to_db(self, fetch_as_dict=True) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
-        con = sqlite3.connect(self.db_file_name)
-        if fetch_as_dict:
-            con.row_factory = lambda c, r: {l[0]: r[i]
-                                            for i, l in enumerate(c.description)}
-        return (con, con.cursor())
+        '''
+        Returns this thread's connection and a new cursor on it.
+        The connection is opened the first time a thread asks for it, then reused.
+        Rows are `sqlite3.Row`s, or plain tuples if `fetch_as_dict=False`.
+        '''
+        con = getattr(self._local, "con", None)
+        if con is None:
+            # Only this thread uses it, but close() may be called from another one
+            con = sqlite3.connect(self.db_file_name, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("PRAGMA busy_timeout=5000")
+            con.execute("PRAGMA cache_size=-65536")  # 64MB page cache
+            con.execute("PRAGMA temp_store=MEMORY")
+            con.row_factory = sqlite3.Row
+            self._local.con = con
+            self._local.data_version = con.execute("PRAGMA data_version").fetchone()[0]
+            self._connections.append(con)
+
+        cur = con.cursor()
+        if not fetch_as_dict:
+            cur.row_factory = None
+        return (con, cur)
 
     def _create_db(self):
         con, cur = self._connect_to_db()
@@ -145,72 +298,312 @@ class EntityDB_SQLite(EntityDB):
             f"CREATE TABLE {ENTITY_TABLE} ({PRIMARY_KEY} INTEGER PRIMARY KEY)")
         con.commit()
 
-    def _load_entity_from_cids(self, eid: int, components: dict[str, int]) -> Entity:
+    def _migrate_component_tables(self) -> None:
         '''
-        Turns a row from the _entities table into an entity object.
-        Only able to create components for ones that have been registered!
+        Databases written before components were stored inline have a table for each component,
+        with an `_entity` column pointing back at the entity. Their fields are copied into
+        the entities table and the old tables are dropped, all in one transaction.
         '''
-        result = Entity([])
-        result.uid = eid
-        con, cur = self._connect_to_db()
-        for comp_name in components:
-            if comp_name in self.component_classes:
-                cur.execute(
-                    f"SELECT * FROM {comp_name} WHERE {PRIMARY_KEY} == ?", [components[comp_name]])
-                component_data: dict = cur.fetchone()
+        con, cur = self._connect_to_db(False)
+        cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name != ?", [ENTITY_TABLE])
+        tables = [row[0] for row in cur.fetchall()]
+
+        cur.execute("BEGIN")
+        with con:
+            for table in tables:
+                cur.execute(f"PRAGMA table_info({table})")
+                columns = [row[1] for row in cur.fetchall()]
+                if ENTITY_REFERENCE not in columns:
+                    continue
 
-                if not component_data:
+                entity_columns = self._get_table_columns(cur, ENTITY_TABLE)
+                if table not in entity_columns:
+                    # No entity was ever given this component, so there is nothing to copy
+                    cur.execute(f"DROP TABLE {table}")
                     continue
 
-                component_type = self.component_classes[comp_name]
-                new_component = self._create_component_from_data(
-                    component_type, component_data, components[comp_name])
-                result._components[component_type] = new_component
-            else:
-                result._unloaded_components.append(comp_name)
-                #print("load entity: skipping unregistered component:", comp_name)
+                fields = [column for column in columns if column not in (PRIMARY_KEY, ENTITY_REFERENCE)]
+                field_columns = [get_field_column(table, field) for field in fields]
+                for column in field_columns:
+                    if column not in entity_columns:
+                        cur.execute(f"ALTER TABLE {ENTITY_TABLE} ADD {column}")
+                        entity_columns.add(column)
+
+                # The entity's column for the component holds the component's UID
+                if fields:
+                    cur.execute(
+                        f"UPDATE {ENTITY_TABLE} SET ({', '.join(field_columns)}) = "
+                        f"(SELECT {', '.join(fields)} FROM {table} WHERE {table}.{PRIMARY_KEY} = {ENTITY_TABLE}.{table}) "
+                        f"WHERE {table} IS NOT NULL")
+                cur.execute(f"DROP TABLE {table}")
+
+    def _run_batch(self, system: SystemWrapper, rows: list[tuple]) -> None:
+        '''
+        Runs a batch system on rows from the system's query in `run()`.
+        The rows are split into columns for the system, and written back
+        from those columns if it saves them.
+        '''
+        if not rows:
+            return
+        import numpy
+
+        row_columns = list(zip(*rows))
+        uids = row_columns[0]
+        columns = [make_columns(component_type, fields, row_columns[field_index:field_index + len(fields)], system.batch.compiled)
+                   for component_type, cid_index, field_index, fields in system.loaded_components]
+
+        commands = system.run_batch(columns)
+
+        con, cur = self._connect_to_db()
+        if commands & DELETE_ENTITY:
+            with con:
+                cur.executemany(
+                    f"DELETE FROM {ENTITY_TABLE} WHERE {PRIMARY_KEY} = ?", [[uid] for uid in uids])
+            for uid in uids:
+                self._set_archetype(uid, None)
+
+        elif commands & SAVE_ENTITY:
+            with con:
+                for (component_type, cid_index, field_index, fields), component_columns in zip(system.loaded_components, columns):
+                    if fields:
+                        # tolist() turns NumPy values back into Python ones SQLite can store
+                        cur.executemany(f"UPDATE {ENTITY_TABLE} SET {self._component_statements[component_type].update_set} WHERE {PRIMARY_KEY} = ?",
+                                        zip(*[numpy.asarray(getattr(component_columns, field)).tolist() for field in fields], uids))
+
+    def _create_entity_from_row(self, row: tuple, system: SystemWrapper, archetype: Archetype) -> Entity:
+        '''
+        Turns a row from the system's query in `run()` into an entity object, given the archetype it was found in.
+        Components that are not in the system's signature are left unloaded,
+        they get loaded when `Entity.get` asks for them.
+        '''
+        result = Entity([])
+        result.uid = row[0]
+        result.db = self
+
+        # Which components get loaded only depends on the archetype, so it's worked out once for each
+        plan: LoadPlan = archetype.plans.get(system)
+        if plan is None:
+            plan = archetype.plans[system] = LoadPlan(
+                tuple(loaded for loaded in system.loaded_components if loaded[0].__name__ in archetype.names),
+                tuple(name for name in archetype.names if name not in system.loaded_names))
+
+        components = result._components
+        for component_type, cid_index, field_index, fields in plan.components:
+            # SQLite stores values in their native types, so they go straight into the constructor
+            component = component_type(
+                **dict(zip(fields, row[field_index:field_index + len(fields)])))
+            component._uid = row[cid_index]
+            components[component_type] = component
+
+        if plan.unloaded:
+            result._unloaded_components = list(plan.unloaded)
+
+        return result
+
+    def _create_component_from_data(self, component_type: type, component_data: dict[str, any], cid: any = None) -> object:
+        # SQLite stores values in their native types, so there is nothing to deserialize
+        component_vars = self.get_instance_variables(component_type)
+        result = component_type(
+            **{varname: component_data[varname] for varname in component_vars})
+        result._uid = cid
+        return result
+
+    def _get_table_columns(self, cursor: sqlite3.Cursor, table_name: str) -> set[str]:
+        '''
+        Returns the set of column names in a table. The schema is only read the first
+        time a table is asked for, after that the cached set is returned.
+        Add to the returned set when altering the table, to keep it up to date.
+        '''
+        columns = self._table_columns.get(table_name)
+        if columns is None:
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            # The name is the second column, read by index so plain tuple cursors work too
+            columns = {row[1] for row in cursor.fetchall()}
+            self._table_columns[table_name] = columns
+        return columns
+
+    def _get_archetypes(self) -> dict[frozenset[str], Archetype]:
+        '''
+        Returns `_archetypes`, reading every entity's components from the database
+        to build it the first time this is called.
+        '''
+        if self._archetypes is None:
+            con, cur = self._connect_to_db(False)
+            component_columns = [column for column in self._get_table_columns(cur, ENTITY_TABLE)
+                                 if column != PRIMARY_KEY and FIELD_DELIMITER not in column]
+            cur.execute(
+                f"SELECT {', '.join([PRIMARY_KEY] + component_columns)} FROM {ENTITY_TABLE}")
+            rows = cur.fetchall()
+
+            # Only set once the scan has worked, so a failed one is tried again next time
+            self._archetypes = dict()
+            for row in rows:
+                self._set_archetype(row[0], frozenset(
+                    name for name, cid in zip(component_columns, row[1:]) if cid is not None))
+        return self._archetypes
 
-        con.close()
+    def _check_for_outside_writes(self) -> None:
+        '''
+        Throws away the archetype index if another connection has written to the database
+        since this thread last looked, so it is built again on the next query.
+        SQLite changes a connection's `data_version` whenever a different connection commits.
+        '''
+        con, cur = self._connect_to_db(False)
+        cur.execute("PRAGMA data_version")
+        data_version = cur.fetchone()[0]
+        if data_version == self._local.data_version:
+            return
+        self._local.data_version = data_version
+
+        if self._archetypes is not None:
+            self._archetypes = None
+            self._entity_archetypes.clear()
+            self._component_index.clear()
+            self._query_cache.clear()
+            # Columns may have been added too
+            self._table_columns.pop(ENTITY_TABLE, None)
+
+    def _set_archetype(self, uid: int, names: frozenset[str]) -> None:
+        '''
+        Moves an entity into the archetype with the given component names.
+        Removes it from the index if `names` is None.
+        '''
+        if self._archetypes is None:
+            # Not built yet, it will pick up this change when it is
+            return
+
+        old_archetype = self._entity_archetypes.pop(uid, None)
+        if old_archetype is not None:
+            old_archetype.uids.discard(uid)
+
+        if names is not None:
+            archetype = self._archetypes.get(names)
+            if archetype is None:
+                archetype = self._archetypes[names] = Archetype(names, self._get_mask(names))
+                for name in names:
+                    self._component_index.setdefault(name, []).append(archetype)
+                # Queries this archetype matches need to include it now
+                for key in [key for key in self._query_cache if archetype.matches(*key)]:
+                    del self._query_cache[key]
+            self._entity_archetypes[uid] = archetype
+            archetype.uids.add(uid)
+
+    def _find_archetypes(self, system: SystemWrapper) -> list[Archetype]:
+        '''
+        Returns each archetype that matches the system's signature.
+        '''
+        self._check_for_outside_writes()
+        required_mask, excluded_mask = key = (system.required_mask, system.excluded_mask)
+        result = self._query_cache.get(key)
+        if result is None:
+            archetypes = self._get_archetypes()
+            # Matching archetypes have every required component,
+            # so only the archetypes of the rarest one need to be looked at
+            candidates = min((self._component_index.get(name, []) for name in system.required_names),
+                             key=len, default=list(archetypes.values()))
+            # A cached query that requires and excludes less matches everything this one does,
+            # so if one of those has fewer archetypes it is filtered instead
+            for (cached_required, cached_excluded), cached in self._query_cache.items():
+                if not cached_required & ~required_mask and not cached_excluded & ~excluded_mask \
+                        and len(cached) < len(candidates):
+                    candidates = cached
+            result = [archetype for archetype in candidates if archetype.matches(*key)]
+            self._query_cache[key] = result
         return result
 
+    def _get_mask(self, names: frozenset[str]) -> int:
+        '''
+        Returns a bitset of the given component names.
+        Names that haven't been seen before are given the next free bit.
+        '''
+        mask = 0
+        for name in names:
+            bit = self._component_bits.get(name)
+            if bit is None:
+                bit = self._component_bits[name] = 1 << len(self._component_bits)
+            mask |= bit
+        return mask
+
+    def _setup_system(self, system: SystemWrapper) -> None:
+        '''
+        Builds the query for this system, so `run()` only has to execute it.
+        '''
+        # Only the columns of the components in the system's signature are selected.
+        # For each of them keep where their UID and fields are in the row
+        system.required_mask = self._get_mask(system.required_names)
+        system.excluded_mask = self._get_mask(system.excluded_names)
+
+        select_columns = [PRIMARY_KEY]
+        system.loaded_components = []
+        system.loaded_names = system.required_names | system.optional_names
+        for component_type in dict.fromkeys(system.get_components_from_signature()):
+            statements = self._component_statements[component_type]
+            system.loaded_components.append((
+                component_type,
+                len(select_columns),
+                len(select_columns) + 1,
+                statements.fields
+            ))
+            select_columns += statements.columns
+
+        # The UIDs to load are added to the end, like "... IN (?,?,?)".
+        # Every chunk but the last has the most parameters, so that one is built now
+        system.select_sql = f"SELECT {', '.join(select_columns)} FROM {ENTITY_TABLE} WHERE {PRIMARY_KEY} IN"
+        system.select_full_sql = f"{system.select_sql} ({get_questionmarks(MAX_QUERY_PARAMETERS)})"
+
     def _setup_component_type(self, component: type) -> None:
         component_name = component.__name__
         con, cur = self._connect_to_db()
-        cur.execute(
-            f"CREATE TABLE IF NOT EXISTS {component_name} ({PRIMARY_KEY} INTEGER PRIMARY KEY, {ENTITY_REFERENCE} INTEGER)")
         variables = EntityDB.get_instance_variables(component)
-        for var_name in variables:
-            if not does_column_exist(cur, component_name, var_name):
-                cur.execute(f"ALTER TABLE {component_name} ADD {var_name}")
+        fields = tuple(variables.keys())
+        columns = (component_name,) + \
+            tuple(get_field_column(component_name, field) for field in fields)
 
-        # Create its column in the entities table
-        if not does_column_exist(cur, ENTITY_TABLE, component_name):
+        entity_columns = self._get_table_columns(cur, ENTITY_TABLE)
+        if component_name not in entity_columns:
             cur.execute(
                 f"ALTER TABLE {ENTITY_TABLE} ADD {component_name} INTEGER")
+            entity_columns.add(component_name)
+
+        for column in columns[1:]:
+            if column not in entity_columns:
+                cur.execute(f"ALTER TABLE {ENTITY_TABLE} ADD {column}")
+                entity_columns.add(column)
 
         con.commit()
-        con.close()
+
+        # Build the statements for this component now, rather than on every insert or update
+        self._component_statements[component] = ComponentStatements(
+            fields=fields,
+            columns=columns,
+            insert_columns=",".join(columns),
+            insert_placeholders=get_questionmarks(len(columns)),
+            update_set=", ".join(f"{column} = ?" for column in columns[1:]),
+            select=f"SELECT {', '.join(columns)} FROM {ENTITY_TABLE} WHERE {PRIMARY_KEY} = ?"
+        )
+
+
+def get_archetype_of(entity: Entity) -> frozenset[str]:
+    '''
+    Returns the names of every component an entity has, loaded or not
+    '''
+    return frozenset(component_type.__name__ for component_type in entity._components) | \
+        frozenset(entity._unloaded_components)
 
 
-def does_column_exist(cursor: sqlite3.Cursor, table_name: str, column_name: str) -> bool:
-    cursor.execute(
-        f"SELECT COUNT(*) FROM pragma_table_info('{table_name}') WHERE name='{column_name}'")
-    result = cursor.fetchone()
-    if isinstance(result, tuple):
-        return result[0] == 1
-    elif isinstance(result, dict):
-        return result["COUNT(*)"] == 1
+def get_field_column(component_name: str, field: str) -> str:
+    '''
+    Returns the name of the column in the entities table that stores
+    a field of a component
+    '''
+    return f"{component_name}{FIELD_DELIMITER}{field}"
 
 
+@functools.lru_cache(maxsize=128)
 def get_questionmarks(amount: int) -> str:
     '''
     Returns a string of question marks with commas, like
     "?,?,?,?" for amount = 4
     '''
-
-    if amount < 1:
-        return ""
-    elif amount == 1:
-        return "?"
-    else:
-        return "?" + str(",?" * (amount - 1))
+    return ",".join("?" * amount)
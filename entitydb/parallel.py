@@ -0,0 +1,38 @@
+import os
+from typing import Callable, NamedTuple
+
+
+# Set on functions marked with @parallel_system, holds their ParallelInfo
+PARALLEL_ATTRIBUTE = "__entitydb_parallel__"
+
+
+class ParallelInfo(NamedTuple):
+    workers: int
+    '''How many threads the matched entities are split between'''
+
+
+def parallel_system(func: Callable = None, *, workers: int = None) -> Callable:
+    '''
+    Marks a system as safe to run on many entities at the same time.
+    The matched entities are split into one contiguous chunk per worker thread,
+    and each chunk is run on its own thread.
+
+    Threads only speed things up when the system spends its time outside of Python code,
+    like NumPy work, file or network IO. Pure Python systems are held back by the GIL,
+    see `entitydb.batch` for a faster way to run those.
+
+    ## Rules
+    - The system should only change the entity it is given.
+    - Saves and deletes are still done together once every chunk has finished.
+    - `BREAK` stops every chunk, but other chunks may have already run on a few later entities.
+    - The entity index is the same as it would be for a normal run.
+
+    `workers` defaults to the number of CPUs.
+    '''
+    def decorate(func: Callable) -> Callable:
+        setattr(func, PARALLEL_ATTRIBUTE, ParallelInfo(workers or os.cpu_count() or 1))
+        return func
+
+    if func is None:
+        return decorate
+    return decorate(func)
@@ -1,33 +1,43 @@
 import pickle
+from typing import Callable
 
 
-def serialize(value: object) -> tuple[any, str]:
-    '''Returns the final object and its mime type in a tuple'''
-    t = type(value)
+# How to encode each type, and its mime type. Anything else is pickled
+_ENCODERS: dict[type, tuple[Callable[[object], bytes], str]] = {
+    str: (str.encode, "text/plain"),
+    bytes: (bytes, "application/octet-stream"),
+    int: (lambda value: str(value).encode(), "text/plain"),
+    float: (lambda value: repr(value).encode(), "text/plain"),
+    bool: (lambda value: b"1" if value else b"0", "text/plain"),
+}
 
-    if t is str:
-        return value, "text/plain"
+# Pickles start with the PROTO opcode. Text never does, as it isn't a valid first byte in UTF-8
+PICKLE_PREFIX = pickle.PROTO
 
-    elif t is bytes:
-        return value, "application/octet-stream"
+# How to decode each type, by the type it should be turned back into
+_DECODERS: dict[type, Callable[[bytes], object]] = {
+    str: bytes.decode,
+    bytes: bytes,
+    int: int,
+    float: float,
+    bool: lambda value: value == b"1",
+}
 
-    elif t is int:
-        return str(value), "text/plain"
 
-    # No special overrides found, use pickle
-    return pickle.dumps(value), "application/octet-stream"
+def serialize(value: object) -> tuple[bytes, str]:
+    '''Returns the final object and its mime type in a tuple'''
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        # No special overrides found, use pickle
+        return pickle.dumps(value), "application/octet-stream"
+    encode, mime_type = encoder
+    return encode(value), mime_type
 
 
 def deserialize(value: bytes, out_type: type) -> object:
-
-    if out_type is str:
-        return value.decode()
-
-    elif out_type is bytes:
-        return value
-
-    elif out_type is int:
-        return int(value)
-
-    # No special overrides found, use pickle
-    return pickle.loads(value)
+    decode = _DECODERS.get(out_type)
+    # Values stored before they had their own encoding (like bools and floats) were pickled
+    if decode is None or (out_type is not bytes and value[:1] == PICKLE_PREFIX):
+        # No special overrides found, use pickle
+        return pickle.loads(value)
+    return decode(value)
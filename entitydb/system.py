@@ -1,134 +1,318 @@
-from enum import Enum
-import dataclasses
+from enum import IntFlag
 import inspect
-from typing import Callable
+import numbers
+import weakref
+from typing import Callable, NamedTuple
 from entitydb.entity import Entity
+from entitydb.component import is_component
+from entitydb.batch import BATCH_ATTRIBUTE, BatchInfo
+from entitydb.parallel import PARALLEL_ATTRIBUTE, ParallelInfo
 
 import entitydb
 
-class SystemCommands(Enum):
+class SystemCommands(IntFlag):
     '''
     Return values from this enum in Systems
-    to tell the EntityDB what to do
+    to tell the EntityDB what to do.
+
+    Each value is its own bit, so commands can be combined with `|`,
+    like `SystemCommands.SAVE_ENTITY | SystemCommands.BREAK`.
     '''
 
-    # * Entity operations in group 100
+    # * Entity operations
 
-    SAVE_ENTITY = 100  # Saves the current entity
-    DELETE_ENTITY = 101  # Deletes the current entity
+    SAVE_ENTITY = 1  # Saves the current entity
+    DELETE_ENTITY = 2  # Deletes the current entity
 
-    # * Flow control in group 200
+    # * Flow control
 
-    BREAK = 200  # Stop running this system
+    BREAK = 4  # Stop running this system
     '''
     Works the same as the `break` keyword in loops
     '''
 
 
+def parse_commands(system_output: object, allow_ints: bool = False) -> int:
+    '''
+    Turns what a system returned into a bitmask of `SystemCommands` values.
+    Systems can return a command, a list of them, or nothing.
+
+    Plain ints are ignored like any other value, unless `allow_ints` is set.
+    Only batch systems compiled with Numba need it, as they can't return `SystemCommands`.
+    '''
+    # Let the system return stuff in various formats for ease of use.
+    # This runs for every entity, so the common cases are checked first by exact type
+    if system_output is None:
+        return 0
+
+    output_type = type(system_output)
+    if output_type is SystemCommands:
+        return system_output.value
+
+    elif output_type is list:
+        result = 0
+        for command in system_output:
+            # Anything in the list that isn't a command is ignored too
+            if type(command) is SystemCommands:
+                result |= command.value
+        return result
+
+    elif allow_ints and isinstance(system_output, numbers.Integral) and output_type is not bool:
+        # Batch systems compiled with Numba can only return plain ints, which may be NumPy ints
+        return int(system_output)
+
+    return 0
+
+
+# Set on system functions the first time they are parsed, holds their SystemInfo
+INFO_ATTRIBUTE = "__entitydb_info__"
+
+# Set on system functions the first time an EntityDB runs them, holds their SystemWrapper for each EntityDB.
+# Kept on the function rather than the EntityDB, so systems made on the fly (like closures) are freed with their wrappers
+WRAPPERS_ATTRIBUTE = "__entitydb_wrappers__"
+
+
+class SystemInfo(NamedTuple):
+    '''
+    What a system asks for in its signature. Doesn't depend on any EntityDB,
+    so it is shared by every `SystemWrapper` of the same function.
+    '''
+    include_components: tuple[tuple[str, type], ...]
+    '''Argument name and type of each required component'''
+    optional_components: tuple[tuple[str, type], ...]
+    '''Argument name and type of each optional component'''
+    exclude_components: frozenset[type]
+    entity_input: str
+    edb_input: str
+    index_input: str
+    arg_names: tuple[str, ...]
+    '''Names of the system's positional arguments, in order'''
+    signature_types: tuple[type, ...]
+    '''Required then optional component types'''
+    required_names: frozenset[str]
+    optional_names: frozenset[str]
+    excluded_names: frozenset[str]
+    batch: BatchInfo
+    '''Set if this is a batch system, see `entitydb.batch.batch_system`'''
+    parallel: ParallelInfo
+    '''Set if this system can be run on many entities at once, see `entitydb.parallel.parallel_system`'''
+
+
+def get_system_info(system: Callable) -> SystemInfo:
+    '''
+    Parses the signature of a system. The result is stored on the function,
+    so each function is only inspected once, even across EntityDBs.
+    '''
+    result: SystemInfo = getattr(system, INFO_ATTRIBUTE, None)
+    if result is not None:
+        return result
+
+    # Which components we are searching for
+    components: dict[str, type] = {}
+    optional_components: dict[str, type] = {}
+    exclude_components: frozenset[type] = frozenset()
+    entity_input = ""
+    edb_input = ""
+    index_input = ""
+
+    # Parse function input to see what to give it
+    arg_names, annotations, defaults = get_arguments_of(system)
+    for arg in arg_names:
+        # Check if it is an annotated or plain arg
+        if arg in annotations:
+            # args includes the type of object this func wants to return, ignore it.
+            if arg == "return":
+                continue
+
+            elif is_component(annotations[arg]):
+                if arg.startswith("opt_"):
+                    optional_components[arg] = annotations[arg]
+                else:
+                    components[arg] = annotations[arg]
+
+            elif annotations[arg] is entitydb.EntityDB:
+                if edb_input:
+                    raise Exception(
+                        "Can't have multiple of the same type!")
+                edb_input = arg
+
+            elif annotations[arg] is Entity:
+                if entity_input:
+                    raise Exception(
+                        "Can't have multiple of the same type!")
+                entity_input = arg
+
+            elif annotations[arg] is int:
+                if index_input:
+                    raise Exception(
+                        "Can't have multiple of the same type!")
+                index_input = arg
+
+        else:
+            if arg == "exclude":
+                exclude_components = frozenset(defaults[arg])
+
+    batch: BatchInfo = getattr(system, BATCH_ATTRIBUTE, None)
+    if batch is not None and (optional_components or entity_input or edb_input or index_input):
+        raise Exception(
+            "Batch systems can only take required components!")
+
+    parallel: ParallelInfo = getattr(system, PARALLEL_ATTRIBUTE, None)
+    if batch is not None and parallel is not None:
+        raise Exception(
+            "A system can't be both a batch and a parallel system!")
+
+    result = SystemInfo(
+        tuple(components.items()), tuple(optional_components.items()), exclude_components,
+        entity_input, edb_input, index_input, arg_names,
+        tuple(components.values()) + tuple(optional_components.values()),
+        # Component names, made once so every query by this system shares the same sets
+        frozenset(component_type.__name__ for component_type in components.values()),
+        frozenset(component_type.__name__ for component_type in optional_components.values()),
+        frozenset(component_type.__name__ for component_type in exclude_components),
+        batch, parallel)
+    try:
+        setattr(system, INFO_ATTRIBUTE, result)
+    except AttributeError:
+        # Things like bound methods can't have attributes set, they just get parsed every time
+        pass
+    return result
+
+
+def get_arguments_of(system: Callable) -> tuple[tuple[str, ...], dict[str, object], dict[str, object]]:
+    '''
+    Returns the names of the positional arguments a function is called with, in order,
+    its annotations and its defaults by argument name. `self` is left out of bound methods.
+    Reads the function's code object directly, which is a lot cheaper than `inspect`.
+    '''
+    func = getattr(system, "__func__", system)
+    code = getattr(func, "__code__", None)
+    if code is None:
+        # Not a plain function, like a callable object or a partial
+        parameters = [parameter for parameter in inspect.signature(system).parameters.values()
+                      if parameter.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)]
+        return (tuple(parameter.name for parameter in parameters),
+                {parameter.name: parameter.annotation for parameter in parameters
+                 if parameter.annotation is not inspect.Parameter.empty},
+                {parameter.name: parameter.default for parameter in parameters
+                 if parameter.default is not inspect.Parameter.empty})
+
+    arg_names = code.co_varnames[:code.co_argcount]
+    defaults = func.__defaults__ or ()
+    defaults = dict(zip(arg_names[len(arg_names) - len(defaults):], defaults))
+    if func is not system:
+        # Bound method, self is already passed in
+        arg_names = arg_names[1:]
+    return arg_names, func.__annotations__, defaults
+
+
 class SystemWrapper():
-    def __init__(self, edb: 'entitydb.EntityDB', system: Callable) -> None:
-        # Which components we are searching for
-        components: dict[str, type] = {}
-        optional_components: dict[str, type] = {}
-        exclude_components: list[type] = []
-        entity_input = ""
-        edb_input = ""
-        index_input = ""
-
-        # Parse function input to see what to give it
-        spec = inspect.getfullargspec(system)
-        annotations = spec.annotations
-        for arg in spec.args:
-            # Check if it is an annotated or plain arg
-            if arg in annotations:
-                # args includes the type of object this func wants to return, ignore it.
-                if arg == "return":
-                    continue
-
-                elif dataclasses.is_dataclass(annotations[arg]):
-                    if arg.startswith("opt_"):
-                        optional_components[arg] = annotations[arg]
-                    else:
-                        components[arg] = annotations[arg]
-
-                elif annotations[arg] is entitydb.EntityDB:
-                    if edb_input:
-                        raise Exception(
-                            "Can't have multiple of the same type!")
-                    edb_input = edb
-
-                elif annotations[arg] is Entity:
-                    if entity_input:
-                        raise Exception(
-                            "Can't have multiple of the same type!")
-                    entity_input = arg
-
-                elif annotations[arg] is int:
-                    if index_input:
-                        raise Exception(
-                            "Can't have multiple of the same type!")
-                    index_input = arg
+    '''
+    A system bound to one EntityDB. The signature is parsed into the shared `SystemInfo`,
+    anything the EntityDB works out for running the system is stored here, see `EntityDB._setup_system`.
+    '''
 
-            else:
-                if arg == "exclude":
-                    exclude_components = spec.defaults[0]
+    def __init__(self, edb: 'entitydb.EntityDB', system: Callable) -> None:
+        info = get_system_info(system)
 
-        self.edb: entitydb.EntityDB = edb
+        # Weak, as the wrapper is stored on the system, which can outlive the EntityDB
+        self._edb_ref: weakref.ref = weakref.ref(edb)
         self.system: Callable = system
-        self.include_components = components
-        self.optional_components = optional_components
-        self.exclude_components = exclude_components
-        self.entity_input = entity_input
-        self.edb_input = edb_input
-        self.index_input = index_input
-
-    def run(self, entity: Entity, index: int) -> list[SystemCommands]:
+        self.info: SystemInfo = info
+
+        # Copied from the info, so they are one attribute lookup away
+        self.include_components = info.include_components
+        self.optional_components = info.optional_components
+        self.exclude_components = info.exclude_components
+        self.entity_input = info.entity_input
+        self.edb_input = info.edb_input
+        self.index_input = info.index_input
+        self.arg_names = info.arg_names
+        self.required_names = info.required_names
+        self.optional_names = info.optional_names
+        self.excluded_names = info.excluded_names
+        self.batch = info.batch
+        self.parallel = info.parallel
+
+        self._dispatch: Callable = self._build_dispatch()
+
+    @property
+    def edb(self) -> 'entitydb.EntityDB':
+        return self._edb_ref()
+
+    def run(self, entity: Entity, index: int) -> int:
         '''
         Runs the system using fields from the object. Assumes that the entity has
         all of the correct fields for this function signature.
 
+        Returns the commands given by the system as a bitmask of `SystemCommands` values.
+
         Will throw an exception if the entity passed in does not match!
         '''
-        args: dict[str, object] = {}
+        return parse_commands(self._dispatch(entity, index))
 
-        # Add components to args
-        for arg_name in self.include_components:
-            args[arg_name] = entity._components[self.include_components[arg_name]]
+    def run_batch(self, columns: list[object]) -> int:
+        '''
+        Runs a batch system once, with the columns of each component in `include_components`, in order.
+        Returns the commands given by the system, which apply to every entity in the batch.
+        '''
+        return parse_commands(self.batch.kernel(*columns), self.batch.compiled)
 
-        # Add optional components to args
-        for arg_name in self.optional_components:
-            if self.optional_components[arg_name] in entity._components:
-                args[arg_name] = entity._components[self.optional_components[arg_name]]
-            else:
-                args[arg_name] = None
+    def _build_dispatch(self) -> Callable:
+        '''
+        Generates a function that calls the system with the arguments its signature asks for.
+        This way the per entity work is a single call, without building a dict of kwargs.
+        The system and EntityDB are bound in, so only the entity and its index are passed.
+        Arguments are passed positionally, up until the first one the system doesn't get (like `exclude`).
+
+        The generated function looks like:
+        ```
+        def dispatch(entity, index):
+            components = entity._components
+            return _system(components[_include_0], components.get(_optional_0), entity)
+        ```
+        '''
+        namespace: dict[str, object] = {"_system": self.system, "_edb": self._edb_ref}
+        # What to pass in to each argument
+        values: dict[str, str] = {}
+
+        # Components are looked up by type, the types are passed in through the namespace
+        for i, (arg_name, component_type) in enumerate(self.include_components):
+            namespace[f"_include_{i}"] = component_type
+            values[arg_name] = f"components[_include_{i}]"
+
+        for i, (arg_name, component_type) in enumerate(self.optional_components):
+            namespace[f"_optional_{i}"] = component_type
+            values[arg_name] = f"components.get(_optional_{i})"
 
-        # Add the Entity
         if self.entity_input:
-            args[self.entity_input] = entity
+            values[self.entity_input] = "entity"
 
-        # Add the EntityDB
         if self.edb_input:
-            args[self.edb_input] = self.edb
+            values[self.edb_input] = "_edb()"
 
-        # Add the index
         if self.index_input:
-            args[self.index_input] = index
-
-        system_output = self.system(**args)
+            values[self.index_input] = "index"
 
-        # Parse the output and return a system command list
-        result: list[SystemCommands] = []
-
-        # Let the system return stuff in various formats for ease of use
-        if system_output:
-            if isinstance(system_output, list):
-                result = system_output
-            elif isinstance(system_output, SystemCommands):
-                result = [system_output]
+        args: list[str] = []
+        positional = True
+        for arg_name in self.arg_names:
+            if arg_name not in values:
+                # Skipping an argument means the ones after it need their names
+                positional = False
+            elif positional:
+                args.append(values[arg_name])
+            else:
+                args.append(f"{arg_name}={values[arg_name]}")
 
-        return result
+        source = "def dispatch(entity, index):\n"
+        if self.include_components or self.optional_components:
+            source += "    components = entity._components\n"
+        source += f"    return _system({', '.join(args)})\n"
+        exec(compile(source, "<system dispatch>", "exec"), namespace)
+        return namespace["dispatch"]
 
-    def get_components_from_signature(self) -> list[type]:
+    def get_components_from_signature(self) -> tuple[type, ...]:
         '''
         Returns every component type mentioned in this system's signature (via type hints),
         except for excluded components because we don't care too much about them.
@@ -136,4 +320,4 @@ class SystemWrapper():
         # ? Probably don't need to know about excluded components, as this function is only
         # ? used by the EntityDB to register them. Might change in the future, keep an eye on this.
         # + self.exclude_components
-        return list(self.include_components.values()) + list(self.optional_components.values())
+        return self.info.signature_types